@@ -28,6 +28,12 @@ from .common import manager as mm, MorpherCheckOperator
 
 logger = logging.getLogger(__name__)
 
+psys_vg_attrs = (
+    "vertex_group_clump", "vertex_group_density", "vertex_group_field", "vertex_group_kink",
+    "vertex_group_length", "vertex_group_rotation", "vertex_group_roughness_1", "vertex_group_roughness_2",
+    "vertex_group_roughness_end", "vertex_group_size", "vertex_group_tangent", "vertex_group_twist",
+    "vertex_group_velocity")
+
 
 def sk_to_verts(obj, sk):
     if isinstance(sk, str):
@@ -36,7 +42,8 @@ def sk_to_verts(obj, sk):
             sk = k.key_blocks.get(sk)
     if sk is None:
         return
-    arr = numpy.empty(len(sk.data) * 3)
+    # float32 matches vertex coordinates, so foreach_get/foreach_set can copy data directly
+    arr = numpy.empty(len(sk.data) * 3, dtype=numpy.float32)
     sk.data.foreach_get("co", arr)
     obj.data.vertices.foreach_set("co", arr)
 
@@ -137,12 +144,9 @@ def _add_modifiers(ui):
 
 
 def _do_vg_cleanup():
-    unused_l1 = set()
     m = mm.morpher.core
     current_l1 = m.L1
-    for l1 in m.morphs_l1:
-        if l1 != current_l1:
-            unused_l1.add(l1)
+    unused_l1 = {l1 for l1 in m.morphs_l1 if l1 != current_l1}
 
     obj = m.obj
 
@@ -151,12 +155,10 @@ def _do_vg_cleanup():
         hair_vg.name = "hair"
 
     # Make sure we won't delete any vertex groups used by hair particle systems
-    for psys in obj.particle_systems:
-        for attr in dir(psys):
-            if attr.startswith("vertex_group_"):
-                vg = getattr(psys, attr)
-                if vg.startswith("hair_"):
-                    unused_l1.remove(vg[5:])
+    unused_l1 -= {
+        vg[5:] for psys in obj.particle_systems
+        for vg in (getattr(psys, attr, "") for attr in psys_vg_attrs)
+        if vg.startswith("hair_")}
 
     for vg in obj.vertex_groups:
         if vg.name.startswith("joint_") or (
@@ -18,7 +18,7 @@
 #
 # Copyright (C) 2020-2022 Michael Vigovsky
 
-import logging, numpy
+import array, itertools, logging, numpy
 
 import bpy, mathutils  # pylint: disable=import-error
 
@@ -32,6 +32,44 @@ epsilon2 = 1e-15
 bigval = 1/epsilon
 
 
+# Kernels are cached on disk (per argument types) to avoid compiling them in every Blender session
+if utils.numba:
+    from numba import njit, prange  # pylint: disable=import-error
+
+    # gather, multiply and sum binding segments without nnz*3 temporary array
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _fit_fused(arr, idx, weights, positions, out):
+        cnt = len(positions)
+        for i in prange(cnt):
+            end = positions[i + 1] if i + 1 < cnt else len(idx)
+            for k in range(arr.shape[1]):
+                acc = 0.0
+                for j in range(positions[i], end):
+                    acc += arr[idx[j], k] * weights[j]
+                out[i, k] = acc
+
+    # same for 1D weight arrays
+    @njit(fastmath=True, cache=True)
+    def _fit_fused_1d(arr, idx, weights, positions, out):
+        cnt = len(positions)
+        for i in range(cnt):
+            end = positions[i + 1] if i + 1 < cnt else len(idx)
+            acc = 0.0
+            for j in range(positions[i], end):
+                acc += arr[idx[j]] * weights[j]
+            out[i] = acc
+else:
+    _fit_fused = _fit_fused_1d = None
+
+
+def _fit_segments(arr: numpy.ndarray, pos, idx, weights):
+    if _fit_fused is not None and arr.ndim <= 2:
+        out = numpy.empty((len(pos),) + arr.shape[1:], dtype=numpy.result_type(arr, weights))
+        (_fit_fused if arr.ndim == 2 else _fit_fused_1d)(arr, idx, weights.reshape(-1), pos, out)
+        return out
+    return numpy.add.reduceat(arr[idx] * weights, pos)
+
+
 class FitBinding(tuple):
     __slots__ = ()
 
@@ -42,34 +80,80 @@ class FitBinding(tuple):
         for pos, idx, weights in self:
             if is_weights:
                 weights = weights.reshape(-1)
-            arr = numpy.add.reduceat(arr[idx] * weights, pos)
+            arr = _fit_segments(arr, pos, idx, weights)
         return arr
 
 
-def _binding_convert(bind_dict, cut=True):
-    positions = numpy.empty((len(bind_dict)), dtype=numpy.uint32)
-    idx = []
-    weights = []
-    thresh = 0
-    for i, d in enumerate(bind_dict):
-        if cut:
-            thresh = max(d.values()) / 32
-        positions[i] = len(idx)
-        for k, v in d.items():
-            if v >= thresh:
-                idx.append(k)
-                weights.append(v)
-    idx = numpy.array(idx, dtype=numpy.uint32)
-    weights = numpy.array(weights)
-    return positions, idx, weights
+# convert (asset vertex, character vertex, weight) triples to binding arrays,
+# duplicate vertex pairs are reduced with ufunc
+def _binding_merge(asset_idx, char_idx, weights, cnt, ufunc=numpy.maximum, cut=True):
+    order = numpy.lexsort((char_idx, asset_idx))
+    asset_idx = asset_idx[order]
+    char_idx = char_idx[order]
+    weights = weights[order]
+
+    uniq = numpy.empty(len(order), dtype=bool)
+    uniq[:1] = True
+    numpy.not_equal(asset_idx[1:], asset_idx[:-1], out=uniq[1:])
+    uniq[1:] |= char_idx[1:] != char_idx[:-1]
+    starts = uniq.nonzero()[0]
+    weights = ufunc.reduceat(weights, starts)
+    asset_idx = asset_idx[starts]
+    char_idx = char_idx[starts]
+
+    if cut:
+        thresh = numpy.maximum.reduceat(weights, numpy.searchsorted(asset_idx, numpy.arange(cnt))) / 32
+        mask = weights >= thresh[asset_idx]
+        asset_idx = asset_idx[mask]
+        char_idx = char_idx[mask]
+        weights = weights[mask]
+
+    positions = numpy.searchsorted(asset_idx, numpy.arange(cnt)).astype(numpy.uint32)
+    # float32 precision is more than enough for weights and it makes fitting faster
+    return positions, char_idx, weights.astype(numpy.float32)
 
 
 def _binding_normalize(positions, wresult):
-    cnt = numpy.empty((len(positions)), dtype=numpy.uint32)
-    cnt[:-1] = positions[1:]
-    cnt[:-1] -= positions[:-1]
-    cnt[-1] = len(wresult) - positions[-1]
-    wresult /= numpy.add.reduceat(wresult, positions).repeat(cnt)
+    cnt = numpy.diff(positions, append=len(wresult))
+    numpy.divide(wresult, numpy.add.reduceat(wresult, positions).repeat(cnt), out=wresult)
+
+
+# barycentric weights of points on triangles, same as poly_3d_calc for triangular faces
+def _tri_weights(tris: numpy.ndarray, locs: numpy.ndarray):
+    v0 = tris[:, 1] - tris[:, 0]
+    v1 = tris[:, 2] - tris[:, 0]
+    v2 = locs - tris[:, 0]
+    d00 = (v0 * v0).sum(1)
+    d01 = (v0 * v1).sum(1)
+    d11 = (v1 * v1).sum(1)
+    d20 = (v2 * v0).sum(1)
+    d21 = (v2 * v1).sum(1)
+    result = numpy.empty((len(locs), 3))
+    result[:, 1] = d11 * d20 - d01 * d21
+    result[:, 2] = d00 * d21 - d01 * d20
+    with numpy.errstate(divide="ignore", invalid="ignore"):  # degenerate triangles give non-finite weights
+        result[:, 1:] /= (d00 * d11 - d01 * d01)[:, None]
+    result[:, 0] = 1 - result[:, 1] - result[:, 2]
+    return result
+
+
+# poly_3d_calc weights for multiple points on geometry faces.
+# Triangles are processed in one numpy pass, other polygons are passed to poly_3d_calc.
+def _poly_weights(geom: "Geometry", face_idx: list, locs: list) -> list:
+    faces = geom.faces
+    result = [None] * len(face_idx)
+    tris = [i for i, idx in enumerate(face_idx) if len(faces[idx]) == 3]
+    if tris:
+        tri_weights = _tri_weights(
+            geom.verts[numpy.array([faces[face_idx[i]] for i in tris])],
+            numpy.array([locs[i] for i in tris]))
+        for i, w, valid in zip(tris, tri_weights.tolist(), numpy.isfinite(tri_weights).all(1).tolist()):
+            if valid:
+                result[i] = w
+    for i, w in enumerate(result):
+        if w is None:
+            result[i] = mathutils.interpolate.poly_3d_calc(geom.face_verts[face_idx[i]], locs[i])
+    return result
 
 
 class Geometry:
@@ -97,13 +181,52 @@ class Geometry:
     def bvh(self):
         return mathutils.bvhtree.BVHTree.FromPolygons(self.verts, self.faces)
 
+    # face vertex coordinates as python lists, ready to be passed to poly_3d_calc
+    @utils.lazyproperty
+    def face_verts(self):
+        flat = self.verts[list(itertools.chain.from_iterable(self.faces))].tolist()
+        result = []
+        i = 0
+        for f in self.faces:
+            i2 = i + len(f)
+            result.append(flat[i:i2])
+            i = i2
+        return result
+
+    # kd tree of face centroids and max distance from centroid to its face vertices.
+    # Allows to cheaply skip bvh lookups when no faces are within given distance.
+    # The radius is global for the whole mesh, so a single large face makes the check much less selective.
+    @utils.lazyproperty
+    def centroid_kd(self):
+        counts = numpy.fromiter((len(f) for f in self.faces), dtype=numpy.intp, count=len(self.faces))
+        flat = self.verts[list(itertools.chain.from_iterable(self.faces))]
+        centers = numpy.add.reduceat(flat, numpy.cumsum(counts) - counts) / counts.reshape(-1, 1)
+        radius = numpy.sqrt(((flat - centers.repeat(counts, 0)) ** 2).sum(1).max())
+        return utils.kdtree_from_np(centers), float(radius)
+
+    def faces_near(self, co, dist):
+        if not self.faces:
+            return False
+        kd, radius = self.centroid_kd
+        return kd.find(co)[2] <= dist + radius
+
     @utils.lazyproperty
     def bbox(self):
         return self.verts.min(axis=0), self.verts.max(axis=0)
 
 
 def mesh_faces(mesh):
-    return [f.vertices for f in mesh.polygons]
+    polys = mesh.polygons
+    starts = numpy.empty(len(polys), dtype=numpy.int32)
+    ends = numpy.empty(len(polys), dtype=numpy.int32)
+    polys.foreach_get("loop_start", starts)
+    polys.foreach_get("loop_total", ends)
+    ends += starts
+    loops = numpy.empty(len(mesh.loops), dtype=numpy.int32)
+    mesh.loops.foreach_get("vertex_index", loops)
+    # Use regular python lists like in Character.faces for compatibility with BVHTree
+    loops = loops.tolist()
+    return [loops[start:end] for start, end in zip(starts.tolist(), ends.tolist())]
 
 
 def geom_mesh(mesh):
@@ -150,6 +273,8 @@ def geom_subset(geom, subset):
 
 
 def geom_morph(geom: Geometry, *morph_list):
+    if all(getattr(morph, "is_identity", False) for morph in morph_list):
+        return geom
     result = geom.copy()
     result.verts = result.verts.copy()
     for morph in morph_list:
@@ -158,48 +283,58 @@ def geom_morph(geom: Geometry, *morph_list):
 
 
 class SoftBinder:
-    bindings: list[dict[int, float]]
     dists_asset: list[float]
 
     def __init__(self, char_geom: Geometry, asset_verts: numpy.ndarray):
         self.char_geom = char_geom
         self.asset_verts = asset_verts
-        self.bindings = []
+        # binding is accumulated as (asset vertex, character vertex, weight) triples
+        self.asset_idx = array.array("I")
+        self.char_idx = array.array("I")
+        self.weights = array.array("d")
         self.dists_asset = []
         self.revset = set()
 
+    def _append(self, i, char_idx, weights):
+        self.asset_idx.extend(itertools.repeat(i, len(weights)))
+        self.char_idx.extend(char_idx)
+        self.weights.extend(weights)
+
     def calc_binding_kd(self):
         kd = self.char_geom.kd
-        for v in self.asset_verts:
+        for i, v in enumerate(self.asset_verts):
             pdata = kd.find_n(v.tolist(), 16)
             dists = [p[2] for p in pdata]
             mindist = min(dists)
             maxdist = max(dists)
             if mindist < epsilon2:
                 self.dists_asset.append(-1)
-                self.bindings.append({item[1]: bigval for item in pdata if item[2] < epsilon2})
+                idx = [item[1] for item in pdata if item[2] < epsilon2]
+                self._append(i, idx, [bigval] * len(idx))
             else:
                 self.dists_asset.append(mindist)
-                self.revset.update(p[1] for p in pdata)
-                self.bindings.append({idx: (1 - (dist / maxdist)) / (max(dist, epsilon)) for _, idx, dist in pdata})
+                idx = [p[1] for p in pdata]
+                self.revset.update(idx)
+                self._append(i, idx, [(1 - (dist / maxdist)) / (max(dist, epsilon)) for dist in dists])
 
     # calculate binding based on distance from asset vertices to character faces
     def calc_binding_direct(self):
         if max(self.dists_asset) < epsilon2:
             return
-        verts = self.char_geom.verts
         faces = self.char_geom.faces
         bvh = self.char_geom.bvh
-        for i, (v, bdist, binding) in enumerate(zip(self.asset_verts, self.dists_asset, self.bindings)):
+        hits = []
+        for i, (v, bdist) in enumerate(zip(self.asset_verts, self.dists_asset)):
             if bdist < epsilon2:
                 continue
             bdist *= 0.75
             for loc, _, idx, fdist in bvh.find_nearest_range(v.tolist(), bdist):
-                face = faces[idx]
                 self.dists_asset[i] = min(self.dists_asset[i], fdist)
-                fdist = (1 - fdist / bdist) / max(fdist, epsilon)
-                for vi, bw in zip(face, mathutils.interpolate.poly_3d_calc(verts[face].tolist(), loc)):
-                    binding[vi] = max(binding.get(vi, 0), bw*fdist)
+                hits.append((i, loc, idx, (1 - fdist / bdist) / max(fdist, epsilon)))
+
+        bweights = _poly_weights(self.char_geom, [hit[2] for hit in hits], [hit[1] for hit in hits])
+        for (i, _, idx, coeff), bws in zip(hits, bweights):
+            self._append(i, faces[idx], [bw*coeff for bw in bws])
 
     def calc_binding_reverse(self, asset_geom):
         dthresh = min(max(self.dists_asset), dist_thresh)
@@ -207,19 +342,25 @@ class SoftBinder:
             return
         self.char_geom.verts_filter_set(self.revset)
         cverts = self.char_geom.verts
-        verts = asset_geom.verts
         faces = asset_geom.faces
         bvh = asset_geom.bvh
+        hits = []
         for i in self.revset:
             loc, _, idx, fdist = bvh.find_nearest(cverts[i].tolist(), dthresh)
-            if idx is None:
-                continue
-            face = faces[idx]
+            if idx is not None:
+                hits.append((i, loc, idx, fdist))
+
+        asset_idx = self.asset_idx
+        char_idx = self.char_idx
+        weights = self.weights
+        bweights = _poly_weights(asset_geom, [hit[2] for hit in hits], [hit[1] for hit in hits])
+        for (i, _, idx, fdist), bws in zip(hits, bweights):
             coeff = (1 - fdist / dthresh) / max(fdist, epsilon2)
-            for vi, bw in zip(face, mathutils.interpolate.poly_3d_calc(verts[face].tolist(), loc)):
+            for vi, bw in zip(faces[idx], bws):
                 if self.dists_asset[vi] > fdist:
-                    d = self.bindings[vi]
-                    d[i] = max(d.get(i, 0), bw * coeff)
+                    asset_idx.append(vi)
+                    char_idx.append(i)
+                    weights.append(bw * coeff)
 
     def initial_bind(self, t: utils.Timer):
         self.calc_binding_kd()
@@ -227,27 +368,35 @@ class SoftBinder:
         self.calc_binding_direct()
         t.time("bvh direct")
 
+    def get_binding(self, cut=True):
+        return _binding_merge(
+            numpy.frombuffer(self.asset_idx, dtype=numpy.uint32),
+            numpy.frombuffer(self.char_idx, dtype=numpy.uint32),
+            numpy.frombuffer(self.weights),
+            len(self.asset_verts), numpy.maximum, cut)
+
 
 class HardBinder(SoftBinder):
     # calculate binding based on distance from asset vertices to character faces
     def calc_binding_direct(self):
-        verts = self.char_geom.verts
         faces = self.char_geom.faces
         bvh = self.char_geom.bvh
-        for v in self.asset_verts:
-            loc, _, idx, fdist = bvh.find_nearest(v.tolist())
-            if loc is None:
-                continue
-            face = faces[idx]
+        hits = [bvh.find_nearest(v) for v in self.asset_verts.tolist()]
+        fdists = numpy.array([0 if hit[2] is None else hit[3] for hit in hits])
+        self.dists_asset = fdists.tolist()
+        coeffs = (1 / numpy.maximum(fdists, epsilon)).tolist()
+
+        found = [i for i, hit in enumerate(hits) if hit[2] is not None]
+        bweights = _poly_weights(self.char_geom, [hits[i][2] for i in found], [hits[i][0] for i in found])
+        for i, bws in zip(found, bweights):
+            face = faces[hits[i][2]]
             self.revset.update(face)
-            self.dists_asset.append(fdist)
-            fdist = 1 / max(fdist, epsilon)
-            self.bindings.append({vi: bw*fdist
-                for vi, bw in zip(face, mathutils.interpolate.poly_3d_calc(verts[face].tolist(), loc))})
+            coeff = coeffs[i]
+            self._append(i, face, [bw*coeff for bw in bws])
 
     def calc_binding_kd(self):
         kd = self.char_geom.kd
-        for v, fdist, binding in zip(self.asset_verts, self.dists_asset, self.bindings):
+        for i, (v, fdist) in enumerate(zip(self.asset_verts, self.dists_asset)):
             if fdist < epsilon2:
                 continue
             fdist = min(fdist * 1.5, fdist + dist_thresh)
@@ -257,9 +406,9 @@ class HardBinder(SoftBinder):
             if len(kdata)>24:
                 kdata = kdata[:24]
             coeff = 2 / (fdist - min([item[2] for item in kdata]))
-            for _, idx, dist in kdata:
-                self.revset.add(idx)
-                binding[idx] = max(binding.get(idx, 0), (fdist - dist) * coeff / max(dist, epsilon))
+            idx = [item[1] for item in kdata]
+            self.revset.update(idx)
+            self._append(i, idx, [(fdist - dist) * coeff / max(dist, epsilon) for _, _, dist in kdata])
 
     def initial_bind(self, t: utils.Timer):
         self.calc_binding_direct()
@@ -347,7 +496,7 @@ class FitCalculator:
         if asset_geom:
             b.calc_binding_reverse(asset_geom)
             t.time("bvh reverse")
-        positions, idx, wresult = _binding_convert(b.bindings)
+        positions, idx, wresult = b.get_binding()
         _binding_normalize(positions, wresult)
         t.time("finalize")
         return positions, idx, wresult.reshape(-1, 1)
@@ -369,10 +518,14 @@ class FitCalculator:
 
     def _transfer_weights_iter_arrays(self, binding: FitBinding, vg_data):
         if self.tmp_buf is None:
-            self.tmp_buf = numpy.empty(len(self.geom.verts))
+            self.tmp_buf = numpy.empty(len(self.geom.verts), dtype=numpy.float32)
+        self.tmp_buf.fill(0)
+        prev_idx = ()
         for name, idx, weights in utils.vg_read(vg_data):
-            self.tmp_buf.fill(0)
+            # reset only weights of previous vertex group instead of the whole buffer
+            self.tmp_buf.put(prev_idx, 0)
             self.tmp_buf.put(idx, weights)
+            prev_idx = idx
             yield name, binding.fit(self.tmp_buf, True)
 
     def _transfer_weights_get(self, binding, vg_data, cutoff=1e-4):
@@ -397,6 +550,7 @@ class MorpherFitCalculator(FitCalculator):
         if subset:
             geom = geom_subset(geom, subset)
         super().__init__(geom)
+        self.morph_geom_cache = {}
 
     def _get_asset_conf(self, obj):
         if not obj:
@@ -409,34 +563,68 @@ class MorpherFitCalculator(FitCalculator):
 
     def get_char_geom(self, afd: AssetFitData) -> Geometry:
         if afd and afd.morph:
-            return geom_morph(self.geom, afd.morph)
+            # keep morphed geometry to reuse its bvh and kd trees for other assets with the same morph
+            result = self.morph_geom_cache.get(afd.morph)
+            if result is None:
+                result = geom_morph(self.geom, afd.morph)
+                self.morph_geom_cache[afd.morph] = result
+            return result
         return self.geom
 
 
+def _kd_query(kd, verts, n):
+    pdata = [kd.find_n(v, n) for v in verts]
+    if pdata:
+        n = min(len(item) for item in pdata)  # kd tree can contain less than n points
+    idx = numpy.array([[p[1] for p in item[:n]] for item in pdata], dtype=numpy.uint32).reshape(-1, n)
+    dist = numpy.array([[p[2] for p in item[:n]] for item in pdata]).reshape(-1, n)
+    return idx, dist
+
+
+def _kd_weights(dist, _epsilon):
+    result = 1 - dist / dist.max(axis=1, keepdims=True)
+    result /= numpy.maximum(dist, _epsilon)
+    return result
+
+
+def _kd_reverse_weights(dist, _epsilon):
+    return 1 / numpy.maximum(dist ** 2, _epsilon)
+
+
 # calculate binding based on nearest vertices
 def _calc_binding_kd(kd, verts, _epsilon, n):
-    result = []
-    for v in verts:
-        pdata = kd.find_n(v, n)
-        maxdist = max([p[2] for p in pdata])
-        result.append({idx: (1 - (dist / maxdist)) / (max(dist, _epsilon)) for _, idx, dist in pdata})
-    return result
+    idx, dist = _kd_query(kd, verts, n)
+    asset_idx = numpy.arange(len(idx), dtype=numpy.uint32).repeat(idx.shape[1])
+    return asset_idx, idx.reshape(-1), _kd_weights(dist, _epsilon).reshape(-1)
 
 
 # calculate binding based on distance from character vertices to assset faces
-def _calc_binding_reverse(bind_dict, char_geom, asset_geom):
-    verts = asset_geom.verts
+def _calc_binding_reverse(char_geom, asset_geom):
     faces = asset_geom.faces
     bvh = asset_geom.bvh
+    hits = []
     for i, cvert in char_geom.verts_enum():
-        loc, _, idx, fdist = bvh.find_nearest(cvert.tolist(), dist_thresh)
-        if idx is None:
+        cvert = cvert.tolist()
+        if not asset_geom.faces_near(cvert, dist_thresh):
             continue
+        loc, _, idx, fdist = bvh.find_nearest(cvert, dist_thresh)
+        if idx is not None:
+            hits.append((i, loc, idx, fdist))
+
+    asset_idx = array.array("I")
+    char_idx = array.array("I")
+    weights = array.array("d")
+    bweights = _poly_weights(asset_geom, [hit[2] for hit in hits], [hit[1] for hit in hits])
+    for (i, _, idx, fdist), bws in zip(hits, bweights):
         face = faces[idx]
         fdist = (1 - fdist / dist_thresh) / max(fdist, 1e-15)  # using lower epsilon to avoid some artifacts
-        for vi, bw in zip(face, mathutils.interpolate.poly_3d_calc([verts[i] for i in face], loc)):
-            d = bind_dict[vi]
-            d[i] = d.get(i, 0) + bw * fdist
+        asset_idx.extend(face)
+        char_idx.extend(itertools.repeat(i, len(face)))
+        weights.extend(bw * fdist for bw in bws)
+    return (
+        numpy.frombuffer(asset_idx, dtype=numpy.uint32),
+        numpy.frombuffer(char_idx, dtype=numpy.uint32),
+        numpy.frombuffer(weights))
 
 
 class RiggerFitCalculator(FitCalculator):
@@ -445,20 +633,24 @@ class RiggerFitCalculator(FitCalculator):
 
     # when transferring joints to another geometry, we need to make sure
     # that every original vertex will be mapped to new topology
-    def _calc_binding_kd_reverse(self, weights, kd):
-        for i, vert in self.geom.verts_enum():
-            for _, vi, dist in kd.find_n(vert, 4):
-                d = weights[vi]
-                d[i] = d.get(i, 0) + 1 / max(dist**2, 1e-5)
+    def _calc_binding_kd_reverse(self, kd):
+        char_idx, verts = zip(*self.geom.verts_enum())
+        idx, dist = _kd_query(kd, verts, 4)
+        char_idx = numpy.array(char_idx, dtype=numpy.uint32).repeat(idx.shape[1])
+        return idx.reshape(-1), char_idx, _kd_reverse_weights(dist, 1e-5).reshape(-1)
 
     def get_binding(self, target: AssetFitData):
         t = utils.Timer()
         cg = self.get_char_geom(target)
-        # calculate weights based on nearest vertices
-        bind_dict = _calc_binding_kd(cg.kd, target.geom.verts, 1e-5, 16)
-        self._calc_binding_kd_reverse(bind_dict, target.geom.kd)
-        _calc_binding_reverse(bind_dict, cg, target.geom)
-        result = _binding_convert(bind_dict, False)
+        # every pass returns (asset vertex, character vertex, weight) arrays, duplicate pairs are summed
+        asset_idx, char_idx, weights = zip(
+            _calc_binding_kd(cg.kd, target.geom.verts, 1e-5, 16),
+            self._calc_binding_kd_reverse(target.geom.kd),
+            _calc_binding_reverse(cg, target.geom),
+        )
+        result = _binding_merge(
+            numpy.concatenate(asset_idx), numpy.concatenate(char_idx), numpy.concatenate(weights),
+            len(target.geom.verts), numpy.add, False)
         t.time("rigger calc time")
         return FitBinding(result)
 
@@ -490,4 +490,5 @@ class Fitter(hair.HairFitter):
     def clear_cache(self):
         self.bind_cache.clear()
         self.geom_cache.clear()
+        self.morph_geom_cache.clear()
         self.children = None
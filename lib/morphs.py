@@ -27,16 +27,25 @@ logger = logging.getLogger(__name__)
 
 class Morph:
     __slots__ = ()
+    is_identity = True
 
     def apply(self, verts: numpy.ndarray, _=None):
         return verts
 
 
 class FullMorph(Morph):
-    __slots__ = ("delta",)
+    __slots__ = ("delta", "_is_identity")
 
     def __init__(self, delta):
         self.delta = delta
+        self._is_identity = None
+
+    # computed only once, deltas are read-only arrays
+    @property
+    def is_identity(self):
+        if self._is_identity is None:
+            self._is_identity = bool((numpy.abs(self.delta) < 1e-7).all())
+        return self._is_identity
 
     def get_delta(self, value):
         return self.delta if value is None else self.delta * value
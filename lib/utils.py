@@ -36,6 +36,13 @@ except ImportError:
     logger.debug("Using bundled yaml library!")
 
 
+# Numba isn't shipped with Blender, so use it only if user installed it
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
 # set some yaml styles
 class MyDumper(Dumper):
     pass
@@ -183,9 +190,11 @@ def get_basis_verts(data):
 
 
 def verts_to_numpy(data):
-    arr = numpy.empty(len(data) * 3)
+    # Read coordinates with their native float32 type so foreach_get can do a plain copy,
+    # casting the whole array afterwards is much faster than per-element conversion
+    arr = numpy.empty(len(data) * 3, dtype=numpy.float32)
     data.foreach_get("co", arr)
-    return arr.reshape(-1, 3)
+    return arr.astype(numpy.float64).reshape(-1, 3)
 
 
 def get_basis_numpy(data):